@@ -1,21 +1,63 @@
 """This file may be distributed under the terms of the GNU GPLv3 license"""
 import dbm
 import dbm.dumb
+import json
 import os
 import shelve
 import time
-from threading import Thread, Lock
+from threading import Event, Thread, Lock
 from typing import Union
 
 _DB_NAME = "motion_minder"
+_AXIS_INDEX = {"x": 0, "y": 1, "z": 2}
+_FLUSH_INTERVAL = 30  # seconds between odometer writes while moving
+_FLUSH_DISTANCE = 1000000  # mm traveled since the last write that forces an earlier write
+_JOURNAL_MAX_RECORDS = 1000  # journal records written before folding them into the snapshot
 _UNIT_CONVERSION_FACTORS = {
     "mm": 1,  # millimeters to millimeters (baseline)
     "m": 1000,  # millimeters to meters
     "km": 1000000,  # millimeters to kilometers
 }
+_UNITS_BY_MAGNITUDE = ("mm", "m", "km")  # indexed by how many of 1e3 and 1e6 the value reaches
+_VALID_PARAMS = frozenset({"SET_ODOMETER", "SET_MAINTENANCE", "AXES", "UNIT", "RELATIVE"})
+_VALID_AXES = frozenset("xyz")
+_VALID_UNITS = frozenset({"mm", "m", "km", None})
+_TRUE_VALUES = frozenset({"true", "yes", "1"})
+_FALSE_VALUES = frozenset({"false", "no", "0"})
+
+
+def _get_recommended_unit(value: Union[int, float]) -> str:
+    """
+    Get the magnitude of the value and return the recommended unit.
+
+    :param value: The value in mm.
+    :return: The recommended unit. It can be 'mm', 'm' or 'km'.
+    """
+    return _UNITS_BY_MAGNITUDE[(value >= 1000) + (value >= 1000000)]
+
+
+def _convert_unit_to_mm(value: Union[int, float], unit: str) -> Union[int, float]:
+    """
+    Convert the value from the desired unit to mm.
+
+    :param value: The value in the desired unit.
+    :param unit: The desired unit. It can be 'mm', 'm' or 'km'.
+    :return: The value in mm.
+    """
+    return value * _UNIT_CONVERSION_FACTORS[unit]
 
 
 class _Args:
+    # same order as the previous dir() based lookup, so the first error reported does not change.
+    _VALIDATORS = (
+        "_val_axes",
+        "_val_input_parameters",
+        "_val_relative",
+        "_val_set_maintenance",
+        "_val_set_odometer",
+        "_val_unit",
+    )
+
     def __init__(self, gcmd, gcode):
         """
         This class is used to validate the parameters of the MOTION_MINDER command.
@@ -37,13 +79,12 @@ class _Args:
 
     def _validate(self) -> None:
         """
-        Validate all parameters calling all methods that start with 'val_'.
+        Validate all parameters calling all methods listed in _VALIDATORS.
 
         :return:
         """
-        for attr_name in dir(self):
-            if attr_name.startswith('_val_') and callable(getattr(self, attr_name)):
-                getattr(self, attr_name)()
+        for attr_name in self._VALIDATORS:
+            getattr(self, attr_name)()
 
     def _val_input_parameters(self) -> None:
         """
@@ -60,7 +101,7 @@ class _Args:
         """
         params = self._gcmd.get_command_parameters()
         for key in params:
-            if key not in ["SET_ODOMETER", "SET_MAINTENANCE", "AXES", "UNIT", "RELATIVE"]:
+            if key not in _VALID_PARAMS:
                 raise self._gcode.error(f"Invalid parameter '{key}'.")
 
     def _val_set_odometer(self) -> None:
@@ -95,7 +136,7 @@ class _Args:
         :return:
         """
         for axis in self.axes:
-            if axis not in "xyz":
+            if axis not in _VALID_AXES:
                 raise self._gcode.error(f"Invalid '{axis}' axis.")
         if len(self.axes) != len(set(self.axes)):
             raise self._gcode.error(f"Duplicate axes.")
@@ -109,7 +150,7 @@ class _Args:
 
         :return:
         """
-        if self.unit not in ["mm", "m", "km", None]:
+        if self.unit not in _VALID_UNITS:
             raise self._gcode.error(f"Invalid unit '{self.unit}'. The valid units are 'mm', 'm' and 'km'.")
 
     def _val_relative(self) -> None:
@@ -122,17 +163,17 @@ class _Args:
 
         :return:
         """
-        true_values = ["true", "yes", "1"]
-        false_values = ["false", "no", "0"]
-        if isinstance(self.relative, str):
-            if self.relative.lower() in true_values + false_values:
-                self.relative = self.relative.lower() in true_values
-            else:
-                valid_values = ", ".join(true_values + false_values)
-                raise self._gcode.error(
-                    f"Invalid value '{self.relative}' for 'RELATIVE'. valid values are {valid_values}.")
-        if self.set_odometer is None and self.set_maintenance is None and isinstance(self.relative, str):
+        if not isinstance(self.relative, str):
+            return
+        # checked before converting, self.relative is no longer a string afterwards.
+        if self.set_odometer is None and self.set_maintenance is None:
             raise self._gcode.error("'RELATIVE' can only be used with 'SET_ODOMETER' or 'SET_MAINTENANCE'.")
+        relative = self.relative.lower()
+        if relative in _TRUE_VALUES or relative in _FALSE_VALUES:
+            self.relative = relative in _TRUE_VALUES
+        else:
+            raise self._gcode.error(
+                f"Invalid value '{self.relative}' for 'RELATIVE'. valid values are true, yes, 1, false, no, 0.")
 
 
 class DumbDBMContext:
@@ -164,6 +205,132 @@ class DumbDBMContext:
         dbm._modules = self.original_modules
 
 
+class JournalDB:
+    """
+    Small key/value store made of a JSON snapshot and an append-only JSON lines journal.
+    Each write appends a single line with the changed keys to the journal, so the cost of a
+        write does not depend on the database size, as it happens with dbm.dumb that rewrites the
+        whole file. The journal is folded into the snapshot on open, on close and every
+        _JOURNAL_MAX_RECORDS writes, so neither the files nor the replay on start grow without bound.
+    """
+
+    def __init__(self, fname: str):
+        """
+
+        :param fname: The database file name, without extension.
+        """
+        self._fname = fname
+        self._snapshot_fname = f"{fname}.json"
+        self._journal_fname = f"{fname}.jsonl"
+        self._lock = Lock()
+        self._records = 0
+        self._state = self._load()
+        self.compact()
+        self._fd = os.open(self._journal_fname, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def _load(self) -> dict:
+        """
+        Load the snapshot and replay the journal over it.
+            When none of them exists, the data of the shelve database used by the previous
+            versions is imported.
+
+        :return: The database content.
+        """
+        if not os.path.exists(self._snapshot_fname) and not os.path.exists(self._journal_fname):
+            return self._load_shelve()
+
+        state = {}
+        if os.path.exists(self._snapshot_fname):
+            with open(self._snapshot_fname, "r") as f:
+                state = json.load(f)
+        if os.path.exists(self._journal_fname):
+            with open(self._journal_fname, "r") as f:
+                for line in f:
+                    try:
+                        state.update(json.loads(line))
+                    except ValueError:
+                        # a partial line is left behind if the power is cut while writing it.
+                        continue
+        return state
+
+    def _load_shelve(self) -> dict:
+        """
+        Load the content of the shelve database used by the previous versions.
+
+        :return: The shelve database content or an empty dict if it does not exist.
+        """
+        if not os.path.exists(f"{self._fname}.dat"):
+            return {}
+        with DumbDBMContext():
+            with shelve.open(self._fname, flag="r") as db:
+                state = dict(db)
+        # the maintenance period used to be saved under the 'maintenance' key.
+        if "maintenance" in state:
+            state.setdefault("maintenance_period", state.pop("maintenance"))
+        return state
+
+    def get(self, key: str, default: any = None) -> any:
+        """
+        Get the value of a key.
+
+        :param key: The key to get the value of.
+        :param default: The default value to return if the key does not exist.
+        :return: The value of the key.
+        """
+        return self._state.get(key, default)
+
+    def update(self, mapping: dict) -> None:
+        """
+        Set the values of the given keys, appending them to the journal as a single write.
+
+        :param mapping: The keys and values to set.
+        :return:
+        """
+        record = json.dumps(mapping).encode() + b"\n"
+        with self._lock:
+            # the flush thread can still be writing while klippy closes the database, after a
+            # restart the closed fd number may already belong to the journal of the new instance.
+            if self._fd is None:
+                return
+            self._state.update(mapping)
+            os.write(self._fd, record)
+            os.fsync(self._fd)
+            self._records += 1
+            if self._records >= _JOURNAL_MAX_RECORDS:
+                self.compact()
+
+    def compact(self) -> None:
+        """
+        Write the whole content to the snapshot and empty the journal.
+            The snapshot is written to a temporary file and renamed, so it is never left half written.
+
+        :return:
+        """
+        tmp_fname = f"{self._snapshot_fname}.tmp"
+        with open(tmp_fname, "w") as f:
+            json.dump(self._state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_fname, self._snapshot_fname)
+        with open(self._journal_fname, "w"):
+            pass
+        self._records = 0
+
+    def close(self) -> None:
+        """
+        Fold the journal into the snapshot and close the journal.
+            Writes made after closing are ignored.
+
+        :return:
+        """
+        with self._lock:
+            if self._fd is None:
+                return
+            self.compact()
+            os.close(self._fd)
+            self._fd = None
+
+
 class MotionMinder:
     """
     This plugin keeps track of the distance traveled by the toolhead.
@@ -181,24 +348,31 @@ class MotionMinder:
         self._printer = config.get_printer()
         self._toolhead = None
         self._gcode = self._printer.lookup_object("gcode")
-        self._position = {"x": 0, "y": 0, "z": 0}
-
-        self._db_fname = self._printer.get_start_args().get("config_file", "")
-        self._db_fname = os.path.split(self._db_fname)[0]
-        self._db_fname = os.path.dirname(self._db_fname)  # go back 1 folder level
-        self._db_fname = os.path.join(self._db_fname, "database")
-        os.makedirs(os.path.join(self._db_fname), exist_ok=True)
-        self._db_fname = os.path.join(self._db_fname, _DB_NAME)
-
-        # nbdm is default in some systems, the issue using ndbm it just write the data in the disk when its closed.
-        # opening and closing the file every time when we need to write consume some resources and we start to
-        # have the issue "timer too close" from klipper. Using dumb fix that, even theoretically slower.
-        with DumbDBMContext():
-            with shelve.open(self._db_fname) as db:
-                self._odometer = db.get("odometer", {"x": 0, "y": 0, "z": 0})
+        # Position and odometer are kept as plain lists indexed 0/1/2 for x/y/z, the move
+        # wrapper runs for every toolhead move and list indexing is cheaper than dict lookups.
+        self._pos = [0.0, 0.0, 0.0]
+
+        # the database folder is a sibling of the config folder, e.g. ~/printer_data/database
+        config_file = self._printer.get_start_args().get("config_file", "")
+        db_folder = os.path.join(os.path.dirname(os.path.dirname(config_file)), "database")
+        os.makedirs(db_folder, exist_ok=True)
+        self._db_fname = os.path.join(db_folder, _DB_NAME)
+
+        # dbm.dumb, used before, rewrites the whole file on every write and blocking klipper while doing it
+        # leads to the "timer too close" error. The journal appends a single line per write instead.
+        self._db = JournalDB(self._db_fname)
+        odometer = self._db.get("odometer", {"x": 0, "y": 0, "z": 0})
+        self._odo = [odometer["x"], odometer["y"], odometer["z"]]
+        # the maintenance values only change with SET_MAINTENANCE, they are kept in memory and only written.
+        # they are copied so changing them does not touch the database state before they are journaled.
+        self._next_maintenance = dict(self._db.get("next_maintenance", {"x": None, "y": None, "z": None}))
+        self._maintenance_period = dict(self._db.get("maintenance_period", {"x": None, "y": None, "z": None}))
 
         self._lock = Lock()
         self._update_db = False
+        self._flush_now = False
+        self._flush_event = Event()
+        self._stop = False
         self._ignore_position = False
 
         self._printer.register_event_handler("klippy:mcu_identify", self._get_toolhead)
@@ -206,6 +380,7 @@ class MotionMinder:
             "homing:homing_move_begin", self._home_begin
         )
         self._printer.register_event_handler("homing:homing_move_end", self._home_end)
+        self._printer.register_event_handler("klippy:disconnect", self._disconnect)
 
         self._thread = Thread(target=self._motion_minder_thread)
         self._thread.daemon = True
@@ -239,20 +414,65 @@ class MotionMinder:
         """
         self._ignore_position = False
 
+    def _disconnect(self) -> None:
+        """
+        This is called when klippy is shutting down or restarting and saves the odometer
+            before closing the database.
+
+        :return:
+        """
+        # wake the flush thread so it exits instead of waiting forever on a dead instance
+        self._stop = True
+        self._flush_event.set()
+        self._write_db()
+        self._db.close()
+
     def _motion_minder_thread(self) -> None:
         """
-        This thread is responsible for saving the odometer value to disk every 5 seconds.
+        This thread is responsible for saving the odometer value to disk.
             Its use thread in order to not block the main thread.
+            The thread sleeps on _flush_event until the first move after a write sets it, so an
+            idle printer does not wake it at all. While there is something to write the state is
+            checked every 5 seconds, but the database is only written when _FLUSH_INTERVAL seconds
+            passed since the last write or the toolhead traveled more than _FLUSH_DISTANCE since then,
+            to not wear the SD card with an fsync every 5 seconds.
+            Changes made by the MOTION_MINDER command are written right away.
+
+        :return:
+        """
+        last_flush_time = time.monotonic()
+        last_flush_odo = list(self._odo)
+        while not self._stop:
+            self._flush_event.wait(5 if self._update_db else None)
+            self._flush_event.clear()
+            if self._stop or not self._update_db:
+                continue
+            traveled = sum(abs(a - b) for a, b in zip(self._odo, last_flush_odo))
+            if (not self._flush_now
+                    and time.monotonic() - last_flush_time < _FLUSH_INTERVAL
+                    and traveled < _FLUSH_DISTANCE):
+                continue
+            self._write_db()
+            last_flush_time = time.monotonic()
+            last_flush_odo = list(self._odo)
+
+    def _write_db(self) -> None:
+        """
+        Write the whole state to the database as a single journal record.
+            The lock is only held to take a copy of the values, the disk write happens without it,
+            the move wrapper never takes the lock.
 
         :return:
         """
-        while True:
-            time.sleep(5)
-            if self._update_db:
-                with self._lock, DumbDBMContext():
-                    with shelve.open(self._db_fname) as db:
-                        db["odometer"] = self._odometer
-                    self._update_db = False
+        with self._lock:
+            state = {
+                "odometer": self._get_odometer_dict(),
+                "next_maintenance": dict(self._next_maintenance),
+                "maintenance_period": dict(self._maintenance_period),
+            }
+            self._update_db = False
+            self._flush_now = False
+        self._db.update(state)
 
     def _decorate_move(self, func: callable) -> callable:
         """
@@ -263,18 +483,44 @@ class MotionMinder:
         :return:
         """
 
+        pos = self._pos
+        odo = self._odo
+
         def wrapper(newpos: list, speed: Union[int, float]):
-            for i, axis in enumerate("xyz"):
-                if self._ignore_position:
-                    break
-                if newpos[i] != self._position[axis]:
-                    self._odometer[axis] += abs(newpos[i] - self._position[axis])
-                    self._position[axis] = newpos[i]
+            if not self._ignore_position:
+                # unrolled for x, y and z, this is called for every move.
+                nx, ny, nz = newpos[0], newpos[1], newpos[2]
+                moved = False
+                dx = nx - pos[0]
+                if dx:
+                    odo[0] += -dx if dx < 0 else dx
+                    pos[0] = nx
+                    moved = True
+                dy = ny - pos[1]
+                if dy:
+                    odo[1] += -dy if dy < 0 else dy
+                    pos[1] = ny
+                    moved = True
+                dz = nz - pos[2]
+                if dz:
+                    odo[2] += -dz if dz < 0 else dz
+                    pos[2] = nz
+                    moved = True
+                if moved and not self._update_db:
                     self._update_db = True
+                    self._flush_event.set()
             return func(newpos, speed)
 
         return wrapper
 
+    def _get_odometer_dict(self) -> dict:
+        """
+        Pack the odometer values into the dict format used by the database.
+
+        :return: The odometer values keyed by axis.
+        """
+        return {"x": self._odo[0], "y": self._odo[1], "z": self._odo[2]}
+
     def _get_toolhead(self) -> None:
         """
         This is called when the toolhead is identified and decorates the toolhead.move function.
@@ -304,76 +550,33 @@ class MotionMinder:
             unit = args.unit if args.unit is not None else "km"
             self._set_maintenance(args.set_maintenance, args.axes, unit, args.relative)
 
-    @staticmethod
-    def _get_recommended_unit(value: Union[int, float]) -> str:
-        """
-        Get the magnitude of the value and return the recommended unit.
-
-        :param value: The value in mm.
-        :return: The recommended unit. It can be 'mm', 'm' or 'km'.
-        """
-        if value < 1000:
-            return "mm"
-        elif value < 1000000:
-            return "m"
-        return "km"
-
-    @staticmethod
-    def _convert_mm_to_unit(value: Union[int, float], unit: str) -> Union[int, float]:
-        """
-        Convert the value from mm to the desired unit.
-
-        :param value: The value in mm.
-        :param unit: The desired unit. It can be 'mm', 'm' or 'km'.
-        :return: The value in the desired unit.
-        """
-        return value / _UNIT_CONVERSION_FACTORS.get(unit, 1)
-
-    @staticmethod
-    def _convert_unit_to_mm(value: Union[int, float], unit: str) -> Union[int, float]:
-        """
-        Convert the value from the desired unit to mm.
-
-        :param value: The value in the desired unit.
-        :param unit: The desired unit. It can be 'mm', 'm' or 'km'.
-        :return: The value in mm.
-        """
-        return value * _UNIT_CONVERSION_FACTORS.get(unit, 1)
-
     def _return_odometer(self, required_unit: Union[str, None] = None) -> None:
         """
         Return the odometer value to the user.
 
         :return:
         """
-        result = ""
-        with self._lock, DumbDBMContext():
-            with shelve.open(self._db_fname) as db:
-                next_maintenance = db.get(f"next_maintenance", {"x": None, "y": None, "z": None})
-        for axis in self._odometer:
-            raw_value = self._odometer[axis]
+        parts = []
+        next_maintenance = self._next_maintenance
+        for i, axis in enumerate("xyz"):
+            raw_value = self._odo[i]
 
-            unit = (self._get_recommended_unit(raw_value)
-                    if required_unit is None
-                    else required_unit)
-            value = self._convert_mm_to_unit(raw_value, unit)
-            result += f"{axis.upper()}: {value:.3f} {unit}\n"
+            unit = _get_recommended_unit(raw_value) if required_unit is None else required_unit
+            value = raw_value / _UNIT_CONVERSION_FACTORS[unit]
+            parts.append(f"{axis.upper()}: {value:.3f} {unit}\n")
 
             next_maintenance_axis_raw = next_maintenance[axis]
             if next_maintenance_axis_raw is not None:
-                unit = (self._get_recommended_unit(next_maintenance_axis_raw - raw_value)
-                        if required_unit is None
-                        else required_unit)
-                next_maintenance_axis = self._convert_mm_to_unit(next_maintenance_axis_raw - raw_value, unit)
-                if next_maintenance_axis_raw > raw_value:
-                    result += f"  Next maintenance in: {next_maintenance_axis:.3f} {unit}\n"
+                remaining = next_maintenance_axis_raw - raw_value
+                unit = _get_recommended_unit(remaining) if required_unit is None else required_unit
+                next_maintenance_axis = remaining / _UNIT_CONVERSION_FACTORS[unit]
+                if remaining > 0:
+                    parts.append(f"  Next maintenance in: {next_maintenance_axis:.3f} {unit}\n")
                 else:
-                    result += (
-                        f"  Maintenance due: {next_maintenance_axis:.3f} {unit}\n"
-                    )
+                    parts.append(f"  Maintenance due: {next_maintenance_axis:.3f} {unit}\n")
             else:
-                result += "  Maintenance not set.\n"
-        self._gcode.respond_info(result)
+                parts.append("  Maintenance not set.\n")
+        self._gcode.respond_info("".join(parts))
 
     def _set_odometer(self, value: Union[int, float], axes: str, unit: str, relative: bool) -> None:
         """
@@ -385,13 +588,16 @@ class MotionMinder:
         :param relative: If True the value is added to the current odometer value.
         :return:
         """
-        value = self._convert_unit_to_mm(value, unit)
-        for axis in axes:
-            add_value = self._odometer[axis] if relative else 0
-            self._odometer[axis] = value + add_value
-        with self._lock, DumbDBMContext():
-            with shelve.open(self._db_fname) as db:
-                db["odometer"] = self._odometer
+        value = _convert_unit_to_mm(value, unit)
+        with self._lock:
+            # the axes were already lower cased and validated by _Args.
+            for axis in axes:
+                i = _AXIS_INDEX[axis]
+                add_value = self._odo[i] if relative else 0
+                self._odo[i] = value + add_value
+            self._update_db = True
+            self._flush_now = True
+        self._flush_event.set()
         self._return_odometer()
 
     def _set_maintenance(self, value: Union[int, float], axes: str, unit: str, relative: bool) -> None:
@@ -404,17 +610,15 @@ class MotionMinder:
         :param relative: If True the value will be the current odometer value plus the value.
         :return:
         """
-        value = self._convert_unit_to_mm(value, unit)
-        with self._lock, DumbDBMContext():
-            with shelve.open(self._db_fname) as db:
-                next_maintenance = db.get(f"next_maintenance", {"x": None, "y": None, "z": None})
-                maintenance_period = db.get(f"maintenance_period", {"x": None, "y": None, "z": None})
-                for axis in axes:
-                    add_value = self._odometer[axis] if relative else 0
-                    next_maintenance[axis] = value + add_value
-                    maintenance_period[axis] = value
-                db[f"next_maintenance"] = next_maintenance
-                db[f"maintenance"] = maintenance_period
+        value = _convert_unit_to_mm(value, unit)
+        with self._lock:
+            for axis in axes:
+                add_value = self._odo[_AXIS_INDEX[axis]] if relative else 0
+                self._next_maintenance[axis] = value + add_value
+                self._maintenance_period[axis] = value
+            self._update_db = True
+            self._flush_now = True
+        self._flush_event.set()
         self._return_odometer()
 
 
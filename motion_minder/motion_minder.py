@@ -1,17 +1,31 @@
 """This file may be distributed under the terms of the GNU GPLv3 license"""
 import argparse
+import atexit
+import hashlib
+import itertools
 import json
 import logging
+import mmap
 import os
-import random
 import sys
 import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from logging import handlers
-from threading import Thread
+from threading import Event, Thread
 from typing import Union, Tuple, Dict
 
 import requests
 import websocket
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    # orjson is not required, but it encodes and parses a few times faster
+    from orjson import dumps as _json_dumps, loads as _json_loads
+except ImportError:
+    _json_dumps = json.dumps
+    _json_loads = json.loads
 
 parser = argparse.ArgumentParser(description="Motion Minder")
 parser.add_argument(
@@ -26,6 +40,12 @@ parser.add_argument("--axes", type=str, help="Axes to set.", default="xyz")
 
 MOONRAKER_ADDRESS = "127.0.0.1:7125"
 NAMESPACE = "motion_minder"
+_HISTORY_PAGE_SIZE = 100
+_GCODE_CACHE_KEY = "gcode_cache"
+_GCODE_CACHE_VERSION = 1  # bump it whenever GCodeReader.read returns different distances for the same file
+_JSON_HEADERS = {"Content-Type": "application/json"}
+_CALLBACK_TRACEBACKS = 3  # tracebacks logged for the same callback error before suppressing them
+_CALLBACK_SUMMARY_INTERVAL = 60  # seconds between the summaries of the suppressed errors
 
 _logger = logging.getLogger("motion_minder")
 _logger.setLevel(logging.DEBUG)
@@ -63,15 +83,54 @@ class MoonrakerInterface:
         self._moonraker_address = moonraker_address
         self._namespace = namespace
         self._connect_websocket = connect_websocket
+        self._base_url = f"http://{moonraker_address}"
+        self._db_url = f"{self._base_url}/server/database/item"
+
+        # one keep-alive connection pool shared by all the requests to Moonraker, the
+        # query strings are passed as params so requests encodes them
+        self._session = requests.Session()
+        # idempotent requests are retried when a pooled connection was closed by Moonraker
+        self._session.mount(
+            "http://",
+            HTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=8,
+                max_retries=Retry(total=3, backoff_factor=0.2),
+            ),
+        )
+        # urllib3 also retries GETs that timed out, the history requests have long timeouts
+        # and retrying them would multiply the time it takes to fail
+        self._session.mount(
+            f"{self._base_url}/server/history/",
+            HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=0),
+        )
 
-        self._id = random.randint(0, 10000)
+        # JSON-RPC ids only have to be unique within the connection
+        self._ids = itertools.count(1)
         self._subscribe_objects = {} if subscribe_objects is None else subscribe_objects
         self._on_message_ws_callbacks = [] if ws_callbacks is None else ws_callbacks
+        # (callback id, exception name) -> [errors, suppressed since the last summary, last summary time]
+        self._callback_errors = {}
         self._subscribed = False
+        self._roots = None
+        # the subscription never changes, serialize it only once
+        self._subscribe_payload = json.dumps(
+            {
+                "jsonrpc": "2.0",
+                "method": "printer.objects.subscribe",
+                "params": {"objects": self._subscribe_objects},
+                "id": next(self._ids),
+            }
+        )
+
+        # set on close() so the background threads stop waiting right away
+        self._stop = Event()
+        # close() can run at exit before the websocket is created, e.g. if _setup_logger raises
+        self._websocket = None
+        atexit.register(self.close)
 
         self._setup_logger()
         if self._connect_websocket:
-            self._websocket = None
             self._connect_to_websocket()
 
     def get_key_value(self, key: str, default: any = None) -> Union[str, None]:
@@ -82,13 +141,29 @@ class MoonrakerInterface:
         :param default: The default value to return if the key does not exist.
         :return: The value of the key or None if the key does not exist.
         """
-        base_url = f"http://{self._moonraker_address}/server/database/item?namespace={self._namespace}"
-        response = requests.get(f"{base_url}&key={key}", timeout=3).json()
+        response = self._get_json(
+            self._db_url, params={"namespace": self._namespace, "key": key}, timeout=3
+        )
         if "error" in response:
             return default
         else:
             return response.get("result", {}).get("value", default)
 
+    def get_namespace(self) -> dict:
+        """
+        Get all the keys of the namespace from the database in a single request.
+
+        :return: A dictionary with the keys and values of the namespace, empty if
+            the namespace does not exist.
+        """
+        response = self._get_json(
+            self._db_url, params={"namespace": self._namespace}, timeout=3
+        )
+        if "error" in response:
+            return {}
+        else:
+            return response.get("result", {}).get("value", {})
+
     def set_key_value(
         self, key: str, value: Union[str, int, float]
     ) -> Union[str, None]:
@@ -99,22 +174,58 @@ class MoonrakerInterface:
         :param value: The value to set the key to.
         :return: The value of the key or None if the key does not exist.
         """
-        base_url = f"http://{self._moonraker_address}/server/database/item?namespace={self._namespace}"
-        response = requests.post(f"{base_url}&key={key}&value={value}", timeout=3).json()
+        response = self._post_json(
+            self._db_url, {"namespace": self._namespace, "key": key, "value": value}, timeout=3
+        )
         if "error" in response:
             return None
         else:
             return response.get("result", {}).get("value", None)
 
-    def get_roots(self) -> dict:
+    def set_key_values(self, values: dict) -> dict:
+        """
+        Set several keys of the database in a single JSON-RPC batch request.
+
+        :param values: A dictionary with the keys and the values to set them to.
+        :return: A dictionary with the keys and the values set, None for the keys that
+            could not be set.
+        """
+        batch = [
+            {
+                "jsonrpc": "2.0",
+                "method": "server.database.post_item",
+                "params": {"namespace": self._namespace, "key": key, "value": value},
+                "id": i,
+            }
+            for i, (key, value) in enumerate(values.items())
+        ]
+        response = self._session.post(
+            f"{self._base_url}/server/jsonrpc",
+            data=_json_dumps(batch),
+            headers=_JSON_HEADERS,
+            timeout=3,
+        )
+        if 200 <= response.status_code < 300:
+            responses = {r.get("id"): r for r in _json_loads(response.content)}
+            return {
+                key: responses.get(i, {}).get("result", {}).get("value", None)
+                for i, key in enumerate(values)
+            }
+        # older Moonraker versions don't have the jsonrpc endpoint, set one key at a time
+        return {key: self.set_key_value(key, value) for key, value in values.items()}
+
+    def get_roots(self, refresh: bool = False) -> dict:
         """
-        Get the roots of the files on the printer.
+        Get the roots of the files on the printer. The roots don't change while
+        Moonraker is running, so they are requested only once.
 
+        :param refresh: If True, request the roots again instead of using the cached ones.
         :return: A dictionary of the roots. The key is the name of the root and 
             the value is the root object.
         """
-        endpoint = f"http://{self._moonraker_address}/server/files/roots"
-        response = requests.get(f"{endpoint}", timeout=3).json()
+        if self._roots is not None and not refresh:
+            return self._roots
+        response = self._get_json(f"{self._base_url}/server/files/roots", timeout=3)
         if "error" in response:
             return {}
         else:
@@ -123,6 +234,7 @@ class MoonrakerInterface:
             for folder in folders_list:
                 folders[folder["name"]] = folder
                 folders[folder["name"]].pop("name")
+            self._roots = folders
             return folders
 
     def get_obj(self, obj: str) -> dict:
@@ -132,12 +244,12 @@ class MoonrakerInterface:
         :return: A dictionary of the values of the object. The key is the name of 
             the value and the value is the value.
         """
-        ret = requests.get(
-            f"http://{self._moonraker_address}/printer/objects/query?{obj}", timeout=1
+        ret = self._session.get(
+            f"{self._base_url}/printer/objects/query?{obj}", timeout=1
         )
         try:
             if 200 <= ret.status_code < 300:
-                return ret.json().get("result", {}).get("status", {}).get(obj, {})
+                return _json_loads(ret.content).get("result", {}).get("status", {}).get(obj, {})
             else:
                 _logger.error(
                     f"Error getting the homed axes. GET status code:{ret.status_code}"
@@ -153,46 +265,66 @@ class MoonrakerInterface:
         :param limit: The number of jobs to get. If None, it will get all the jobs.
         :return: A list of the jobs.
         """
-        if limit is None:
-            limit = requests.get(
-                f"http://{self._moonraker_address}/server/history/list?limit=1", timeout=10
-            ).json()["result"]["count"]
-        jobs = requests.get(
-            f"http://{self._moonraker_address}/server/history/list?limit={limit}", timeout=600
-        ).json()["result"]["jobs"]
-        return jobs
+        url = f"{self._base_url}/server/history/list"
+        if limit is not None:
+            return self._get_json(url, params={"limit": limit}, timeout=600)["result"]["jobs"]
+        # older Moonraker versions return nothing for limit=0, so ask for a first page
+        # and only request the whole history when it doesn't fit in it
+        result = self._get_json(url, params={"limit": _HISTORY_PAGE_SIZE}, timeout=60)["result"]
+        if result["count"] > len(result["jobs"]):
+            return self._get_json(
+                url, params={"limit": result["count"]}, timeout=600
+            )["result"]["jobs"]
+        return result["jobs"]
 
-    def _check_klipper_state_routine(self) -> None:
+    def _get_json(
+        self, url: str, timeout: Union[int, float], params: Union[dict, None] = None
+    ) -> Union[dict, list]:
         """
-        Check the klipper state and subscribe to the websocket when it's ready.
-        Always when the Klipper is offline all the websocket subscriptions are lost.
+        Make a GET request and parse the JSON response.
 
-        :return:
+        :param url: The url to request.
+        :param timeout: The timeout of the request in seconds.
+        :param params: The query parameters, they are url encoded by requests.
+        :return: The parsed response.
         """
-        while True:
-            if not self._subscribed:
-                try:
-                    klipper_state = requests.get(
-                        f"http://{self._moonraker_address}/server/info", timeout=1
-                    )
-                    if 200 <= klipper_state.status_code < 300:
-                        klipper_state = klipper_state.json()["result"]["klippy_state"]
-                        if klipper_state == "ready":
-                            self._subscribe(self._subscribe_objects)
-                            self._subscribed = True
-                    else:
-                        _logger.error(
-                            f"Error checking the klipper state.  GET status code {klipper_state.status_code}"
-                        )
-                except Exception as e:
-                    _logger.error(
-                        f"Error checking the klipper state: {e}", exc_info=True
-                    )
-            time.sleep(2)
+        return _json_loads(self._session.get(url, params=params, timeout=timeout).content)
+
+    def _post_json(self, url: str, body: dict, timeout: Union[int, float]) -> Union[dict, list]:
+        """
+        Make a POST request with a JSON body and parse the JSON response.
+
+        :param url: The url to request.
+        :param body: The body of the request, it keeps the types of the values.
+        :param timeout: The timeout of the request in seconds.
+        :return: The parsed response.
+        """
+        response = self._session.post(
+            url, data=_json_dumps(body), headers=_JSON_HEADERS, timeout=timeout
+        )
+        return _json_loads(response.content)
+
+    def _get_klipper_state(self) -> Union[str, None]:
+        """
+        Get the klipper state from the server info.
+
+        :return: The klipper state or None if it could not be retrieved.
+        """
+        try:
+            klipper_state = self._session.get(f"{self._base_url}/server/info", timeout=1)
+            if 200 <= klipper_state.status_code < 300:
+                return _json_loads(klipper_state.content)["result"]["klippy_state"]
+            else:
+                _logger.error(
+                    f"Error checking the klipper state.  GET status code {klipper_state.status_code}"
+                )
+        except Exception as e:
+            _logger.error(f"Error checking the klipper state: {e}", exc_info=True)
+        return None
 
     def _connect_to_websocket(self) -> None:
         """
-        Connect to the websocket and start the thread to check the klipper state.
+        Connect to the websocket in a background thread.
 
         :return:
         """
@@ -201,36 +333,29 @@ class MoonrakerInterface:
             on_message=self._ws_on_message,
             on_open=self._ws_on_open,
         )
-        thread = Thread(target=self._websocket.run_forever, kwargs={"reconnect": True})
+        # the messages are validated by the JSON parser anyway, skip websocket-client's
+        # own per-byte UTF-8 check
+        thread = Thread(
+            target=self._websocket.run_forever,
+            kwargs={"reconnect": True, "skip_utf8_validation": True},
+        )
         thread.daemon = True
         thread.start()
         # self.websocket.run_forever(reconnect=5)
 
-        state_thread = Thread(target=self._check_klipper_state_routine)
-        state_thread.daemon = True
-        state_thread.start()
-
-    def _subscribe(self, subscribe_objects: dict) -> None:
+    def _subscribe(self) -> None:
         """
-        Subscribe to the websocket.
+        Subscribe to the objects in the websocket.
 
-        :param subscribe_objects: The objects to subscribe to.
         :return:
         """
-        self._websocket.send(
-            json.dumps(
-                {
-                    "jsonrpc": "2.0",
-                    "method": "printer.objects.subscribe",
-                    "params": {"objects": subscribe_objects},
-                    "id": self._id,
-                }
-            )
-        )
+        self._websocket.send(self._subscribe_payload)
 
     def _process_klipper_state(self, param: dict) -> None:
         """
         Process the klipper state and subscribe to the websocket when it's ready.
+        Always when the Klipper is offline all the websocket subscriptions are lost,
+        Moonraker notifies every client when it is ready again.
 
         :param param: The message received from the websocket that can contain 
             the klipper state or not.
@@ -239,25 +364,56 @@ class MoonrakerInterface:
         if "method" not in param:
             return
         state = param.get("method", None)
-        if state is not None and state == "notify_klippy_disconnected":
+        if state == "notify_klippy_disconnected":
             self._subscribed = False
+        elif state == "notify_klippy_ready" and not self._subscribed:
+            self._subscribe()
+            self._subscribed = True
 
-    def _ws_on_message(self, _, message: str) -> None:
+    def _ws_on_message(self, _, message: Union[str, bytes]) -> None:
         """
         Callback for the websocket when a message is received.
 
         :param _:
-        :param message: The message received from the websocket.
+        :param message: The message received from the websocket. It is the raw bytes of the
+            frame, as the UTF-8 validation is skipped, both str and bytes are parsed the same way.
         :return:
         """
-        message = json.loads(message)
+        message = _json_loads(message)
         for callback in self._on_message_ws_callbacks:
             try:
                 callback(message)
             except Exception as e:
-                logging.error(f"Error in the callback: {e}", exc_info=True)
+                self._log_callback_error(callback, e)
         self._process_klipper_state(message)
 
+    def _log_callback_error(self, callback, error: Exception) -> None:
+        """
+        Log an error raised by a websocket callback. A broken callback fails on every
+        message, so only the first few tracebacks are logged and the following errors
+        are summarized periodically.
+
+        :param callback: The callback that raised the error.
+        :param error: The error raised.
+        :return:
+        """
+        key = (id(callback), type(error).__name__)
+        stats = self._callback_errors.get(key)
+        if stats is None:
+            stats = self._callback_errors[key] = [0, 0, time.monotonic()]
+        stats[0] += 1
+        if stats[0] <= _CALLBACK_TRACEBACKS:
+            _logger.error(f"Error in the callback: {error}", exc_info=True)
+            return
+        stats[1] += 1
+        now = time.monotonic()
+        if now - stats[2] >= _CALLBACK_SUMMARY_INTERVAL:
+            _logger.error(
+                f"Error in the callback: {error} ({stats[1]} similar errors suppressed)"
+            )
+            stats[1] = 0
+            stats[2] = now
+
     def _ws_on_open(self, _) -> None:
         """
         Callback for the websocket when it's open.
@@ -265,8 +421,30 @@ class MoonrakerInterface:
         :param _:
         :return:
         """
-        if len(self._subscribe_objects) > 0:
-            self._subscribe(self._subscribe_objects)
+        # a new connection has no subscriptions, if the Klipper is not ready yet
+        # the subscription is made when the notify_klippy_ready arrives
+        self._subscribed = False
+        if len(self._subscribe_objects) == 0:
+            return
+        # Moonraker doesn't send notify_klippy_ready again if the Klipper is already ready,
+        # so keep asking until the state is known
+        state = self._get_klipper_state()
+        while state is None and not self._stop.wait(2):
+            state = self._get_klipper_state()
+        if state == "ready":
+            self._subscribe()
+            self._subscribed = True
+
+    def close(self) -> None:
+        """
+        Stop the background threads and close the connections to Moonraker.
+
+        :return:
+        """
+        self._stop.set()
+        if self._connect_websocket and self._websocket is not None:
+            self._websocket.close()
+        self._session.close()
 
     def _setup_logger(self, keep_trying: bool = False) -> None:
         """
@@ -276,7 +454,7 @@ class MoonrakerInterface:
         :return:
         """
         while True:
-            logs_folder = self.get_roots().get("logs", {}).get("path", None)
+            logs_folder = self.get_roots(refresh=keep_trying).get("logs", {}).get("path", None)
             if logs_folder is None and not keep_trying:
                 _logger.warning(
                     "Logs folder not found. Starting a thread to keep trying."
@@ -286,7 +464,8 @@ class MoonrakerInterface:
                 thread.start()
                 break
             if logs_folder is None and keep_trying:
-                time.sleep(2)
+                if self._stop.wait(2):
+                    return
                 continue
             formatter = logging.Formatter(
                 "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
@@ -324,12 +503,12 @@ class MotionMinder(MoonrakerInterface):
         :param z: The value for the z-axis.
         :return:
         """
-        if x is not None:
-            self.set_key_value("odometer_x", x)
-        if y is not None:
-            self.set_key_value("odometer_y", y)
-        if z is not None:
-            self.set_key_value("odometer_z", z)
+        values = {}
+        for axis_value, name in zip([x, y, z], ["x", "y", "z"]):
+            if axis_value is not None:
+                values[f"odometer_{name}"] = axis_value
+        if values:
+            self.set_key_values(values)
 
     def get_odometer(self) -> Tuple[float, float, float]:
         """
@@ -337,9 +516,10 @@ class MotionMinder(MoonrakerInterface):
 
         :return: The odometer values, in the order x, y, z.
         """
-        x = float(self.get_key_value("odometer_x", 0))
-        y = float(self.get_key_value("odometer_y", 0))
-        z = float(self.get_key_value("odometer_z", 0))
+        values = self.get_namespace()
+        x = float(values.get("odometer_x", 0))
+        y = float(values.get("odometer_y", 0))
+        z = float(values.get("odometer_z", 0))
         return x, y, z
 
     def add_mileage(
@@ -347,6 +527,7 @@ class MotionMinder(MoonrakerInterface):
         x: Union[int, float, None] = None,
         y: Union[int, float, None] = None,
         z: Union[int, float, None] = None,
+        extra_values: Union[dict, None] = None,
     ) -> Dict[str, float]:
         """
         Add mileage to the odometer.
@@ -354,16 +535,19 @@ class MotionMinder(MoonrakerInterface):
         :param x: The value for the x-axis to add.
         :param y: The value for the y-axis to add.
         :param z: The value for the z-axis to add.
+        :param extra_values: Other keys to write in the same request as the odometer.
         :return: The current odometer values.
         """
         current_odometer = {}
+        values = self.get_namespace()
         for axis_value, name in zip([x, y, z], ["x", "y", "z"]):
             if axis_value is not None:
-                value = self.get_key_value(f"odometer_{name}")
+                value = values.get(f"odometer_{name}")
                 if value is not None:
                     axis_value += float(value)
-                self.set_key_value(f"odometer_{name}", axis_value)
                 current_odometer[f"odometer_{name}"] = axis_value
+        if current_odometer or extra_values:
+            self.set_key_values({**current_odometer, **(extra_values or {})})
         return current_odometer
 
 
@@ -372,7 +556,8 @@ class GCodeReader:
     Class to read a gcode file and return the distances traveled.
     """
 
-    _VALID_COMMANDS = {"G90", "G91", "G92", "G1", "G0", "M82", "M83"}
+    _VALID_COMMANDS = frozenset({b"G90", b"G91", b"G92", b"G1", b"G0", b"M82", b"M83"})
+    _MODE_COMMANDS = frozenset({b"G90", b"G91", b"M82", b"M83"})
 
     def __init__(self, file_path: str) -> None:
         """
@@ -380,7 +565,14 @@ class GCodeReader:
         :param file_path: The path to the gcode file.
         """
         self._file_path = file_path
-        self._file = open(file_path, "r")
+        # gcode is plain ASCII, reading it as bytes from a memory map avoids the
+        # decoding and makes tell() a cheap byte offset
+        self._file = open(file_path, "rb")
+        try:
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files can't be mapped
+            self._data = None
 
         self._mode = "absolute"
         self._extruder_mode = "absolute"
@@ -400,62 +592,132 @@ class GCodeReader:
         :param max_extrusion: The maximum extrusion value to process.
         :return: The distances traveled by the axes and extruder.
         """
-        distances = self._total_distances.copy()
-
-        while True:
-            if file_position is not None and self._file.tell() >= file_position:
-                break
-            line = self._file.readline()
+        # the state lives in local floats while reading, local names are much cheaper
+        # to access than dict items or attributes inside the loop
+        last_x, last_y, last_z, last_e = self._last_positions.values()
+        total_x, total_y, total_z, total_e = self._total_distances.values()
+        start = self._total_distances.copy()
+        absolute = self._mode == "absolute"
+        extruder_absolute = self._extruder_mode == "absolute"
+        valid_commands = GCodeReader._VALID_COMMANDS
+        mode_commands = GCodeReader._MODE_COMMANDS
+        source = self._file if self._data is None else self._data
+        # count the bytes consumed instead of calling tell() on every line
+        position = source.tell()
+
+        extrusion_limit = None if max_extrusion is None else total_e + max_extrusion
+
+        readline = source.readline
+        while file_position is None or position < file_position:
+            line = readline()
             if not line:
                 break
-            command, *values = line.split(" ")
-            if command not in GCodeReader._VALID_COMMANDS:
+            position += len(line)
+            values = line.split()
+            if not values or values[0] not in valid_commands:
+                continue
+            command = values[0]
+            # mode switches carry no coordinates, handle them without parsing the line
+            if command in mode_commands:
+                if command == b"G90":
+                    absolute = extruder_absolute = True
+                elif command == b"G91":
+                    absolute = extruder_absolute = False
+                elif command == b"M82":
+                    extruder_absolute = True
+                else:
+                    extruder_absolute = False
                 continue
-            moves = {}
-            for value in values:
+
+            x = y = z = e = None
+            for value in values[1:]:
+                axis = value[:1]
                 try:
-                    moves[value[0]] = float(value[1:])
+                    if axis == b"X":
+                        x = float(value[1:])
+                    elif axis == b"Y":
+                        y = float(value[1:])
+                    elif axis == b"Z":
+                        z = float(value[1:])
+                    elif axis == b"E":
+                        e = float(value[1:])
+                    elif b";" in value:
+                        # the rest of the line is a comment, it may contain axis letters, e.g. "G1 X10 ; X homed"
+                        break
                 except ValueError:
-                    pass
-
-            if command == "G90":
-                self._mode = "absolute"
-                self._extruder_mode = "absolute"
-            elif command == "G91":
-                self._mode = "relative"
-                self._extruder_mode = "relative"
-            elif command == "M82":
-                self._extruder_mode = "absolute"
-            elif command == "M83":
-                self._extruder_mode = "relative"
-            elif command in ["G1", "G0"]:
-                for axis in ["X", "Y", "Z"]:
-                    if axis in moves:
-                        current_value = moves[axis]
-                        self._total_distances[axis.lower()] += (
-                            abs(current_value - self._last_positions[axis.lower()])
-                            if self._mode == "absolute"
-                            else current_value
-                        )
-                        self._last_positions[axis.lower()] = current_value
-                if "E" in moves:
-                    self._total_distances["e"] = (
-                        abs(moves["E"] - self._last_positions["e"])
-                        if self._extruder_mode == "absolute"
-                        else moves["E"]
-                    )
-                    self._last_positions["e"] = moves["E"]
-            elif command == "G92":
-                for axis in ["X", "Y", "Z", "E"]:
-                    if axis in moves:
-                        self._last_positions[axis.lower()] = moves[axis]
-
-            if max_extrusion is not None and distances["e"] > max_extrusion:
-                break
-        for axis in ["x", "y", "z", "e"]:
-            distances[axis] = self._total_distances[axis] - distances[axis]
+                    comment = value.find(b";")
+                    if comment == -1:
+                        continue
+                    # a comment glued to a coordinate, e.g. "Y20;move X500", also ends the line
+                    try:
+                        number = float(value[1:comment])
+                    except ValueError:
+                        break
+                    if axis == b"X":
+                        x = number
+                    elif axis == b"Y":
+                        y = number
+                    elif axis == b"Z":
+                        z = number
+                    else:
+                        e = number
+                    break
+
+            if command == b"G92":
+                if x is not None:
+                    last_x = x
+                if y is not None:
+                    last_y = y
+                if z is not None:
+                    last_z = z
+                if e is not None:
+                    last_e = e
+                continue
 
-        return distances
+            # only G0 and G1 are left
+            if absolute:
+                if x is not None:
+                    total_x += abs(x - last_x)
+                    last_x = x
+                if y is not None:
+                    total_y += abs(y - last_y)
+                    last_y = y
+                if z is not None:
+                    total_z += abs(z - last_z)
+                    last_z = z
+            else:
+                if x is not None:
+                    total_x += abs(x)
+                    last_x += x
+                if y is not None:
+                    total_y += abs(y)
+                    last_y += y
+                if z is not None:
+                    total_z += abs(z)
+                    last_z += z
+            if e is not None:
+                # e is the net filament pushed, like Moonraker's filament_used, so retractions
+                # are subtracted in both extruder modes
+                if extruder_absolute:
+                    total_e += e - last_e
+                    last_e = e
+                else:
+                    total_e += e
+                    last_e += e
+                if extrusion_limit is not None and total_e > extrusion_limit:
+                    break
+
+        self._mode = "absolute" if absolute else "relative"
+        self._extruder_mode = "absolute" if extruder_absolute else "relative"
+        self._last_positions = {"x": last_x, "y": last_y, "z": last_z, "e": last_e}
+        self._total_distances = {"x": total_x, "y": total_y, "z": total_z, "e": total_e}
+
+        return {
+            "x": total_x - start["x"],
+            "y": total_y - start["y"],
+            "z": total_z - start["z"],
+            "e": total_e - start["e"],
+        }
 
     def close(self) -> None:
         """
@@ -463,35 +725,97 @@ class GCodeReader:
         
         :return:
         """
+        if self._data is not None:
+            self._data.close()
         self._file.close()
 
 
+def _read_job(gcode_folder: str, job: dict) -> Tuple[float, float, float]:
+    """
+    Read the gcode file of a job and return the distances traveled.
+
+    :param gcode_folder: Path to the gcode folder.
+    :param job: The job from the history.
+    :return: The distances traveled, in the order x, y, z.
+    """
+    if not job["exists"]:
+        return 0.0, 0.0, 0.0
+    if job["status"] != "complete":
+        max_extrusion = job["filament_used"]
+    else:
+        max_extrusion = None
+    reader = GCodeReader(f"{gcode_folder}/{job['filename']}")
+    try:
+        x, y, z, _ = reader.read(max_extrusion=max_extrusion).values()
+    finally:
+        reader.close()
+    return x, y, z
+
+
+def _job_cache_key(gcode_folder: str, job: dict) -> Union[str, None]:
+    """
+    Build the key used to cache the distances of a job. The key changes when the
+    gcode file is modified, the job stopped at a different extrusion or the parser changed.
+
+    :param gcode_folder: Path to the gcode folder.
+    :param job: The job from the history.
+    :return: The cache key or None if the gcode file doesn't exist.
+    """
+    if not job["exists"]:
+        return None
+    fname = f"{gcode_folder}/{job['filename']}"
+    try:
+        stat = os.stat(fname)
+    except OSError:
+        return None
+    max_extrusion = job["filament_used"] if job["status"] != "complete" else None
+    key = f"{_GCODE_CACHE_VERSION}:{fname}:{stat.st_size}:{stat.st_mtime_ns}:{max_extrusion}"
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
 def _process_history(gcode_folder: str, mm: MotionMinder) -> None:
     """
     Process the history of jobs and add the mileage to the odometer.
+    The distances of each gcode file are cached in the database, so only new or
+    modified files are parsed again.
 
     :param gcode_folder: Path to the gcode folder.
     :param mm: The MotionMinder object.
     :return:
     """
     jobs = mm.get_jobs_history()
+    cache = mm.get_key_value(_GCODE_CACHE_KEY, {})
+    keys = [_job_cache_key(gcode_folder, job) for job in jobs]
+    # the same file printed many times is parsed only once
+    pending = {
+        key: job for key, job in zip(keys, jobs) if key is not None and key not in cache
+    }
+    read_job = partial(_read_job, gcode_folder)
+    workers = min(os.cpu_count() or 1, len(pending))
+    if workers > 1:
+        # parsing is CPU bound, so use processes to get past the GIL
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for key, distances in zip(pending, executor.map(read_job, pending.values())):
+                cache[key] = distances
+    else:
+        # a single file or a single core isn't worth starting a pool for
+        for key, job in pending.items():
+            cache[key] = read_job(job)
+
     total_x = 0
     total_y = 0
     total_z = 0
-    for job in jobs:
-        if not job["exists"]:
+    for key in keys:
+        if key is None:
             continue
-        if job["status"] != "complete":
-            max_extrusion = job["filament_used"]
-        else:
-            max_extrusion = None
-        fname = f"{gcode_folder}/{job['filename']}"
-        x, y, z, _ = GCodeReader(fname).read(max_extrusion=max_extrusion).values()
+        x, y, z = cache[key]
         total_x += x
         total_y += y
         total_z += z
 
-    mm.add_mileage(x=total_x, y=total_y, z=total_z)
+    # drop the files that are not in the history anymore
+    cache = {key: cache[key] for key in keys if key is not None}
+    mm.add_mileage(x=total_x, y=total_y, z=total_z, extra_values={_GCODE_CACHE_KEY: cache})
     _query_db(mm)
 
 
@@ -512,11 +836,21 @@ def _set_next_maintenance(
     """
     odo_x, odo_y, odo_z = mm.get_odometer()
 
+    values = {}
+    odometers = {}
     for axis, value, nm in zip(["x", "y", "z"], [odo_x, odo_y, odo_z], [x, y, z]):
         if nm is None:
             continue
-        nm = mm.set_key_value(f"next_maintenance_{axis}", nm * 1e6)
-        mm.set_key_value(f"odometer_on_reset_{axis}", value)
+        values[f"next_maintenance_{axis}"] = nm * 1e6
+        values[f"odometer_on_reset_{axis}"] = value
+        odometers[axis] = value
+    if not values:
+        return
+    # all the keys are written in a single request
+    results = mm.set_key_values(values)
+
+    for axis, value in odometers.items():
+        nm = results[f"next_maintenance_{axis}"]
         _logger.info(
             f"{axis.upper()} maintenance at {(value + float(nm)) / 1e6:.3f} km."
         )
@@ -531,10 +865,11 @@ def _query_db(mm: MotionMinder) -> None:
     """
 
     def get_and_convert_value(key):
-        value = float(mm.get_key_value(key))
+        value = float(values.get(key))
         return value / 1e6
 
     try:
+        values = mm.get_namespace()
         for axis in ["x", "y", "z"]:
             next_maintenance = get_and_convert_value(f"next_maintenance_{axis}")
             value_on_reset = get_and_convert_value(f"odometer_on_reset_{axis}")
@@ -568,12 +903,16 @@ def main(args: argparse.Namespace) -> None:
             kwargs[axis] = args.next_maintenance
         _set_next_maintenance(mm=mm, **kwargs)
     elif args.set_axis is not None:
+        kwargs = {}
         for axis in args.axes.lower():
             if axis not in ["x", "y", "z"]:
                 raise ValueError(
                     "Axis must be `X`, `Y`, `Z`  or any combination e.g: `XYZ`, `XZ`, `ZX`"
                 )
-            mm.set_odometer(**{axis: args.set_axis * 1e6})
+            kwargs[axis] = args.set_axis * 1e6
+        # all the axes are written in a single request
+        mm.set_odometer(**kwargs)
+        for axis in kwargs:
             _logger.info(f"Odometer for axis {axis} reset to {args.set_axis} km")
     elif args.stats:
         _query_db(mm)